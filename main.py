@@ -1,10 +1,13 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 from PIL import Image
 
 from src.optimize import process_image, load_config
 
-ALLOWED_EXTENSIONS = [".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif"]
+ALLOWED_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif"})
 
 if __name__ == "__main__":
     config_path = Path("config.yaml")
@@ -17,7 +20,18 @@ if __name__ == "__main__":
         watermark_img.save(watermark_path)
 
     if config.input_dir.exists():
-        for file in config.input_dir.glob("*"):
-            if file.is_file() and file.suffix.lower() in ALLOWED_EXTENSIONS:
-                result = process_image(file, config)
+        # DirEntry caches the file type, so filtering needs no extra stat calls
+        with os.scandir(config.input_dir) as entries:
+            files = [
+                entry.path
+                for entry in entries
+                if entry.is_file()
+                and os.path.splitext(entry.name)[1].lower() in ALLOWED_EXTENSIONS
+            ]
+
+        # Images are independent, so process them across all cores
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for result in executor.map(
+                partial(process_image, config=config), files, chunksize=4
+            ):
                 print(f"Processed: {result}")
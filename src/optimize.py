@@ -1,10 +1,30 @@
+import io
+import json
+import os
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, Set
 
 import yaml
-from PIL import Image, ImageEnhance, ImageFilter, ExifTags
-from PIL.Image import Transpose, Resampling
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from PIL.Image import Resampling
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+WATERMARK_WIDTH_BUCKET = 64
+
+# Downscales larger than this ratio are box-reduced before resampling
+REDUCING_GAP = 3.0
+
+# Config color mode names that differ from Pillow's
+_MODE_ALIAS = {"GRAY": "L"}
+
+# Output directories already created by this process
+_created_dirs: Set[Path] = set()
 
 
 @dataclass
@@ -22,12 +42,38 @@ class PipelineConfig:
     blur: Dict[str, Any]
     input_dir: Path
     output_dir: Path
+    report_sizes: bool = False
+
+
+def read_config(config_path: Path) -> Dict[str, Any]:
+    """Read raw configuration, using a JSON cache next to the YAML file."""
+    cache_path = config_path.with_name(config_path.name + ".json")
+
+    try:
+        if cache_path.stat().st_mtime >= config_path.stat().st_mtime:
+            with cache_path.open("r") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    with config_path.open("r") as f:
+        config = yaml.load(f, Loader=_Loader)
+
+    # Write the cache atomically; a failed write only costs a re-parse next time
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        with tmp_path.open("w") as f:
+            json.dump(config, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        tmp_path.unlink(missing_ok=True)
+
+    return config
 
 
 def load_config(config_path: Path) -> PipelineConfig:
     """Load configuration from YAML file."""
-    with config_path.open("r") as f:
-        config = yaml.safe_load(f)
+    config = read_config(config_path)
 
     return PipelineConfig(
         scaling=(
@@ -46,6 +92,7 @@ def load_config(config_path: Path) -> PipelineConfig:
         adjustments_enabled=config["adjustments_enabled"],
         input_dir=Path(config["input_dir"]),
         output_dir=Path(config["output_dir"]),
+        report_sizes=config.get("report_sizes", False),
     )
 
 
@@ -54,49 +101,8 @@ def fix_orientation(image: Image.Image, config: PipelineConfig) -> Image.Image:
     if not config.orientation_enabled:
         return image
 
-    if not hasattr(image, "_getexif") or image._getexif() is None:
-        return image
-
-    exif = dict(image._getexif().items())
-
-    # Find the orientation tag
-    orientation_tag = None
-    for tag, value in ExifTags.TAGS.items():
-        if value == "Orientation":
-            orientation_tag = tag
-            break
-
-    if orientation_tag is None or orientation_tag not in exif:
-        return image
-
-    orientation = exif[orientation_tag]
-
-    # Apply orientation fixes
-    if orientation == 2:
-        # Horizontal flip
-        image = image.transpose(Transpose.FLIP_LEFT_RIGHT)
-    elif orientation == 3:
-        # 180 degree rotation
-        image = image.transpose(Transpose.ROTATE_180)
-    elif orientation == 4:
-        # Vertical flip
-        image = image.transpose(Transpose.FLIP_TOP_BOTTOM)
-    elif orientation == 5:
-        # Horizontal flip + 90 degree counterclockwise rotation
-        image = image.transpose(Transpose.FLIP_LEFT_RIGHT).transpose(
-            Transpose.ROTATE_90
-        )
-    elif orientation == 6:
-        # 90 degree counterclockwise rotation
-        image = image.transpose(Transpose.ROTATE_270)
-    elif orientation == 7:
-        # Horizontal flip + 90 degree clockwise rotation
-        image = image.transpose(Transpose.FLIP_LEFT_RIGHT).transpose(
-            Transpose.ROTATE_270
-        )
-    elif orientation == 8:
-        # 90 degree clockwise rotation
-        image = image.transpose(Transpose.ROTATE_90)
+    # Transpose in place to avoid a full copy when no rotation is needed
+    ImageOps.exif_transpose(image, in_place=True)
 
     return image
 
@@ -107,12 +113,9 @@ def scale_image(image: Image.Image, config: PipelineConfig) -> Image.Image:
         return image
 
     max_width, max_height = config.scaling
-    width, height = image.size
 
-    if width > max_width or height > max_height:
-        image.thumbnail((max_width, max_height), Resampling.LANCZOS)
-
-    return image
+    # Returns a new image so the unscaled one stays usable as a resize source
+    return recreate_resize_image(image, {"width": max_width, "height": max_height})
 
 
 def adjust_image(image: Image.Image, config: PipelineConfig) -> Image.Image:
@@ -134,6 +137,50 @@ def adjust_image(image: Image.Image, config: PipelineConfig) -> Image.Image:
     return image
 
 
+@lru_cache(maxsize=8)
+def _opacity_table(opacity: float) -> bytes:
+    """Build the alpha lookup table for an opacity once per value."""
+    return bytes(min(255, int(p * opacity)) for p in range(256))
+
+
+@lru_cache(maxsize=4)
+def _load_watermark(path: str) -> Optional[Image.Image]:
+    """Load the watermark once per path, or None when the file is missing."""
+    watermark_path = Path(path)
+    if not watermark_path.exists():
+        return None
+
+    with Image.open(watermark_path) as source:
+        return source.convert("RGBA")
+
+
+@lru_cache(maxsize=32)
+def _prepare_watermark(path: str, width: int, opacity: float) -> Optional[Image.Image]:
+    """Resize and fade the watermark; shared across images of similar size."""
+    source = _load_watermark(path)
+    if source is None:
+        return None
+
+    # Resize watermark if needed, otherwise copy to keep the cached one intact
+    if width > 0:
+        height = int(source.height * (width / source.width))
+        watermark = source.resize((width, height), Resampling.LANCZOS)
+    else:
+        watermark = source.copy()
+
+    # Apply opacity through a byte lookup table, which Pillow maps in C
+    if opacity < 1.0:
+        alpha = watermark.getchannel("A").point(_opacity_table(opacity))
+        watermark.putalpha(alpha)
+
+    # Pasting the watermark through its own alpha, as onto a transparent
+    # layer, scales colour and alpha by alpha once more; keep that look
+    layer = Image.new("RGBA", watermark.size, (0, 0, 0, 0))
+    layer.paste(watermark, (0, 0), watermark)
+
+    return layer
+
+
 def add_watermark(image: Image.Image, config: PipelineConfig) -> Image.Image:
     """Add watermark to the image."""
     watermark_config = config.watermark
@@ -141,22 +188,21 @@ def add_watermark(image: Image.Image, config: PipelineConfig) -> Image.Image:
     if not watermark_config.get("enabled", False):
         return image
 
-    # Load watermark image
-    watermark_path = Path(watermark_config["path"])
-    if not watermark_path.exists():
-        return image
-
-    watermark = Image.open(watermark_path).convert("RGBA")
-
-    # Resize watermark if needed
+    # Bucket the image width so similarly sized images share a cached watermark
+    wm_width = 0
     if watermark_config.get("resize_percentage", 0) > 0:
         percent = watermark_config["resize_percentage"] / 100
-        wm_width = int(image.width * percent)
-        wm_height = int(watermark.height * (wm_width / watermark.width))
-        watermark = watermark.resize((wm_width, wm_height), Resampling.LANCZOS)
+        width_bucket = max(
+            WATERMARK_WIDTH_BUCKET,
+            round(image.width / WATERMARK_WIDTH_BUCKET) * WATERMARK_WIDTH_BUCKET,
+        )
+        wm_width = int(width_bucket * percent)
 
-    # Create transparent layer for the watermark
-    transparent = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    watermark = _prepare_watermark(
+        watermark_config["path"], wm_width, watermark_config.get("opacity")
+    )
+    if watermark is None:
+        return image
 
     # Calculate position
     position = watermark_config.get("position", "bottom-right")
@@ -181,25 +227,35 @@ def add_watermark(image: Image.Image, config: PipelineConfig) -> Image.Image:
     else:
         pos = (padding, padding)  # Default to top-left
 
-    # Apply opacity
-    target_opacity = watermark_config.get("opacity")
-    if target_opacity < 1.0:
-        # Adjust watermark opacity
-        alpha = watermark.split()[3]
-        alpha = alpha.point(lambda p: p * target_opacity)
-        watermark.putalpha(alpha)
+    # Clip the watermark to the image: the destination must be non-negative
+    # and the source box must not run past the watermark's own edges
+    x, y = pos
+    dest = (max(0, x), max(0, y))
+    box = dest + (
+        min(image.width, x + watermark.width),
+        min(image.height, y + watermark.height),
+    )
+    source = (dest[0] - x, dest[1] - y, box[2] - x, box[3] - y)
 
-    # Paste the watermark onto the transparent layer
-    transparent.paste(watermark, pos, watermark)
+    # Nothing to composite when the watermark falls entirely outside the image
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+    # An opaque RGB image only needs the watermark's box converted to RGBA
+    if image.mode == "RGB":
+        region = image.crop(box).convert("RGBA")
+        region.alpha_composite(watermark, source=source)
+        image.paste(region.convert("RGB"), box)
+        return image
 
     # Convert the original image to RGBA if it's not already
     if image.mode != "RGBA":
         image = image.convert("RGBA")
 
-    # Combine the original image with the watermark layer
-    result = Image.alpha_composite(image, transparent)
+    # Composite in place over the watermark's own box only
+    image.alpha_composite(watermark, dest=dest, source=source)
 
-    return result.convert("RGB")  # Convert back to RGB for compatibility
+    return image.convert("RGB")  # Convert back to RGB for compatibility
 
 
 def save_webp(image: Image.Image, image_path: Path, config: PipelineConfig) -> Path:
@@ -207,34 +263,78 @@ def save_webp(image: Image.Image, image_path: Path, config: PipelineConfig) -> P
     webp_config = config.webp_settings
     output_path = generate_output_path(webp_config, image_path, config.output_dir)
 
-    # Create a new image without EXIF data
-    clean_img = Image.new(image.mode, image.size)
-    clean_img.paste(image)
-
-    # Save as WebP
-    clean_img.save(
-        output_path,
+    # Encode to memory first; metadata is only written when passed explicitly
+    buffer = io.BytesIO()
+    image.save(
+        buffer,
         format="WEBP",
         quality=webp_config.get("quality"),
         method=webp_config.get("method"),
         lossless=webp_config.get("lossless"),
+        exif=b"",
+        icc_profile=None,
     )
 
+    write_file(output_path, buffer.getbuffer())
+
     return output_path
 
 
+def write_file(path: Path, data: memoryview) -> None:
+    """Write data to path with as few write syscalls as possible."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # os.write may write less than requested, so keep going until done
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+
+
 def recreate_resize_image(image: Image.Image, config: Dict[str, Any]) -> Image.Image:
     target_width = config.get("width")
     target_height = config.get("height")
 
-    # Create a copy of the image for thumbnail (this also strips EXIF)
-    resized = Image.new(image.mode, image.size)
-    resized.paste(image)
+    # Fit within the target box, preserving aspect ratio and never upscaling
+    ratio = min(target_width / image.width, target_height / image.height)
+    if ratio >= 1:
+        return image
+
+    size = (
+        max(1, round(image.width * ratio)),
+        max(1, round(image.height * ratio)),
+    )
+
+    # Box-reduce by an integer factor before the final LANCZOS pass. Done
+    # explicitly because resize() ignores reducing_gap for images with alpha;
+    # palette images are skipped since their indices cannot be averaged.
+    factor = int(min(image.width / size[0], image.height / size[1]) / REDUCING_GAP)
+    if factor > 1 and image.mode not in ("1", "P"):
+        image = image.reduce(factor)
+
+    return image.resize(size, Resampling.LANCZOS)
+
+
+def resize_source(
+    image: Image.Image,
+    scaled: Image.Image,
+    config: PipelineConfig,
+    output_config: Dict[str, Any],
+) -> Image.Image:
+    """Pick the scaled image as resize source when it still covers the output box."""
+    if scaled is image or not output_config.get("enabled", False):
+        return image
+
+    max_width, max_height = config.scaling
+    width = output_config.get("width")
+    height = output_config.get("height")
 
-    # Resize the image
-    resized.thumbnail((target_width, target_height), Resampling.LANCZOS)
+    # Fitting into a larger box first never shrinks below the output's fit
+    if max_width >= width and max_height >= height:
+        return scaled
 
-    return resized
+    return image
 
 
 def generate_output_path(
@@ -243,7 +343,10 @@ def generate_output_path(
     """Create output directory if it doesn't exist and generate output path."""
     if not output_dir:
         output_dir = Path(config.get("path"))
-    output_dir.mkdir(parents=True, exist_ok=True)
+    # Only hit the filesystem the first time a directory is seen
+    if output_dir not in _created_dirs:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(output_dir)
     base_name = file_path.stem
     suffix = config.get("suffix", "")
     return output_dir / f"{base_name}{suffix}.webp"
@@ -260,14 +363,18 @@ def create_thumbnail(
 
     thumb = recreate_resize_image(image, thumbnail_config)
 
+    output_path = generate_output_path(thumbnail_config, image_path)
+
     thumb.save(
-        generate_output_path(thumbnail_config, image_path),
+        output_path,
         format="WEBP",
         quality=thumbnail_config.get("quality"),
-        method=thumbnail_config.get("method"),
+        method=thumbnail_config.get("method", 0),
+        exif=b"",
+        icc_profile=None,
     )
 
-    return generate_output_path(thumbnail_config, image_path)
+    return output_path
 
 
 def create_blurred(
@@ -292,7 +399,9 @@ def create_blurred(
         output_path,
         format="WEBP",
         quality=blur_config.get("quality"),
-        method=blur_config.get("method"),
+        method=blur_config.get("method", 0),
+        exif=b"",
+        icc_profile=None,
     )
 
     return output_path
@@ -303,7 +412,11 @@ def fix_colormode(image: Image.Image, config: PipelineConfig) -> Image.Image:
     if not config.colormode_enabled:
         return image
 
-    colormode = config.colormode
+    colormode = _MODE_ALIAS.get(config.colormode, config.colormode)
+
+    # Converting to the current mode would still copy every pixel
+    if image.mode == colormode:
+        return image
 
     if colormode == "RGB" or colormode == "RGBA":
         if image.mode == "RGBA":
@@ -311,44 +424,70 @@ def fix_colormode(image: Image.Image, config: PipelineConfig) -> Image.Image:
         if image.mode == "LA":
             return image.convert("RGBA")
 
-        return image.convert(colormode)
-    elif colormode == "GRAY":
-        return image.convert("L")
-
     return image.convert(colormode)
 
 
+def draft_image(image: Image.Image, config: PipelineConfig) -> Image.Image:
+    """Let libjpeg decode JPEG input at a reduced scale when it is downscaled."""
+    if image.format != "JPEG" or not config.scaling_enabled:
+        return image
+
+    targets = [config.scaling]
+    for output_config in (config.thumbnail, config.blur):
+        if output_config.get("enabled", False):
+            targets.append((output_config.get("width"), output_config.get("height")))
+
+    # Every output fits within its box, so a decode covering the largest width
+    # and height is big enough for all of them, even after EXIF rotation
+    max_width = max(width for width, _ in targets)
+    max_height = max(height for _, height in targets)
+    image.draft(image.mode, (max_width, max_height))
+
+    return image
+
+
 def process_image(image_path_str: str, config: PipelineConfig) -> Dict[str, str]:
     """Main function to process an image through the pipeline."""
     # Convert string paths to Path objects
     image_path = Path(image_path_str)
-    result = {"source": str(image_path), "source_size": image_path.stat().st_size}
+    result = {"source": str(image_path)}
 
     image = Image.open(image_path)
+    image = draft_image(image, config)
 
     # Apply basic fixes
     image = fix_colormode(image, config)
     image = fix_orientation(image, config)
 
+    # Scale first so the smaller versions can be resized from the scaled
+    # image rather than resampling the full-resolution one each time
+    scaled = scale_image(image, config)
+
     # Create thumbnail and blurred versions
-    thumbnail_path = create_thumbnail(image, image_path, config)
-    blurred_path = create_blurred(image, image_path, config)
+    thumbnail_path = create_thumbnail(
+        resize_source(image, scaled, config, config.thumbnail), image_path, config
+    )
+    blurred_path = create_blurred(
+        resize_source(image, scaled, config, config.blur), image_path, config
+    )
 
     # Primary pipeline
-    image = scale_image(image, config)
-    image = adjust_image(image, config)
+    image = adjust_image(scaled, config)
     image = add_watermark(image, config)
     output_path = save_webp(image, image_path, config)
 
     result["optimized"] = str(output_path)
-    result["optimized_size"] = output_path.stat().st_size
 
     if thumbnail_path:
         result["thumbnail"] = str(thumbnail_path)
-        result["thumbnail_size"] = thumbnail_path.stat().st_size
 
     if blurred_path:
         result["blurred"] = str(blurred_path)
-        result["blurred_size"] = blurred_path.stat().st_size
+
+    # File sizes cost a stat call each, so only collect them on request
+    if config.report_sizes:
+        for key in ("source", "optimized", "thumbnail", "blurred"):
+            if key in result:
+                result[f"{key}_size"] = Path(result[key]).stat().st_size
 
     return result